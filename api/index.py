@@ -9,28 +9,48 @@ SSE event types:
   {"agent": "...", "status": "error", "error": "…"}  — agent failed
 """
 
+import asyncio
 import base64
-import json
+import contextlib
+import hashlib
+import io
 import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from typing import AsyncGenerator
 
-from fastapi import FastAPI, HTTPException
+import httpx
+import orjson
+
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+try:
+    import fitz  # PyMuPDF — C-backed, much faster than pypdf
+except ImportError:
+    fitz = None
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
 
 load_dotenv()
 
 # ─── App ──────────────────────────────────────────────────────────────────────
 
 app = FastAPI(title="ORACLE API", version="3.0.0")
+# Only the configured frontend origins may call the API cross-origin.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=[o.strip() for o in os.getenv("FRONTEND_ORIGIN", "http://localhost:3000").split(",")],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization"],
 )
 
 # ─── Models ───────────────────────────────────────────────────────────────────
@@ -40,34 +60,212 @@ class RunRequest(BaseModel):
     resume: str = ""
     resume_pdf: str = ""
 
+# ─── LRU helpers ──────────────────────────────────────────────────────────────
+
+def lru_get(cache: OrderedDict, key):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def lru_put(cache: OrderedDict, key, value, maxsize: int) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > maxsize:
+        cache.popitem(last=False)
+
 # ─── PDF extraction ───────────────────────────────────────────────────────────
 
-def extract_pdf_text(pdf_base64: str) -> str:
-    try:
-        from pypdf import PdfReader
-        import io
-        pdf_bytes = base64.b64decode(pdf_base64)
+# Extracted text is memoised by a hash of the upload so retries and re-submits
+# of the same PDF skip both the base64 decode and the parse.
+PDF_CACHE_SIZE = 64
+
+_pdf_cache: "OrderedDict[bytes, str]" = OrderedDict()
+_pdf_cache_lock = threading.Lock()  # extraction runs on worker threads
+
+def _parse_pdf(pdf_base64: str) -> str:
+    pdf_bytes = base64.b64decode(pdf_base64)
+    if fitz is not None:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            text = "\n\n".join(page.get_text("text") for page in doc).strip()
+        finally:
+            doc.close()
+    elif PdfReader is not None:
         reader = PdfReader(io.BytesIO(pdf_bytes))
         text = "\n\n".join(p.extract_text() or "" for p in reader.pages).strip()
-        if not text:
-            raise ValueError("PDF is empty or image-only (scanned PDF not supported).")
-        return text
-    except ImportError:
-        raise RuntimeError("pypdf not installed. Run: pip install pypdf")
+    else:
+        raise RuntimeError("No PDF library installed. Run: pip install pymupdf")
+    if not text:
+        raise ValueError("PDF is empty or image-only (scanned PDF not supported).")
+    return text
+
+def extract_pdf_text(pdf_base64: str) -> str:
+    key = hashlib.sha256(pdf_base64.encode()).digest()
+    with _pdf_cache_lock:
+        text = lru_get(_pdf_cache, key)
+    if text is None:
+        text = _parse_pdf(pdf_base64)
+        with _pdf_cache_lock:
+            lru_put(_pdf_cache, key, text, PDF_CACHE_SIZE)
+    return text
 
 # ─── OpenAI client ────────────────────────────────────────────────────────────
 
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+_http_client: httpx.AsyncClient | None = None
+_client: AsyncOpenAI | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+
+# Caps in-flight completions across all runs so bursts queue instead of hitting 429s.
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "32"))
+# 429s and transient errors are retried by the SDK, which honours Retry-After.
+OPENAI_MAX_RETRIES = 2
+_llm_sem: asyncio.Semaphore | None = None
+
 def get_client() -> AsyncOpenAI:
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY is not set.")
-    return AsyncOpenAI(
-        api_key=api_key,
-        base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
-    )
+    """Returns the shared client so requests reuse its keep-alive connection pool.
+
+    Pooled connections belong to the loop that opened them, so the client is
+    rebuilt whenever it is used from a different loop (e.g. hosts that run each
+    invocation on a fresh loop); under uvicorn it is built once.
+    """
+    global _client, _http_client, _client_loop, _llm_sem
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENAI_API_KEY is not set.")
+        # Starts from the SDK's own httpx defaults (redirects, 1000 connections)
+        # and adds HTTP/2, a larger keep-alive pool and a longer read timeout
+        # for gaps between streamed chunks.
+        _http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=1024, max_keepalive_connections=512),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            http2=True,
+        )
+        _client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=OPENAI_BASE_URL,
+            http_client=_http_client,
+            max_retries=OPENAI_MAX_RETRIES,
+        )
+        # A semaphore binds to the loop that first waits on it, so it is
+        # rebuilt together with the client.
+        _llm_sem = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+        _client_loop = loop
+    return _client
+
+def get_llm_sem() -> asyncio.Semaphore:
+    """Returns the concurrency cap for the current loop, built alongside the client."""
+    get_client()
+    return _llm_sem
+
+@app.on_event("startup")
+async def warm_client():
+    """Opens a pooled connection ahead of the first run; best-effort only."""
+    try:
+        get_client()
+        await _http_client.head(OPENAI_BASE_URL)
+    except Exception:
+        pass
+
+@app.on_event("shutdown")
+async def close_client():
+    global _client, _http_client, _client_loop, _llm_sem
+    if _client is not None and _client_loop is asyncio.get_running_loop():
+        await _client.close()  # also closes _http_client
+    _client = None
+    _http_client = None
+    _client_loop = None
+    _llm_sem = None
 
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
+# Tokens are coalesced into one SSE event per batch or per flush window.
+TOKEN_BATCH_SIZE = 8
+TOKEN_FLUSH_SECS = 0.02
+
+# ─── Response cache ───────────────────────────────────────────────────────────
+
+# Completions are only reproducible at temperature 0, so caching is limited to that.
+TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", "0.3"))
+CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "128"))
+CACHE_REPLAY_CHARS = 64
+
+_cache: "OrderedDict[str, str]" = OrderedDict()
+
+def cache_key(system: str, user: str) -> str:
+    return hashlib.sha256(f"{MODEL}|{system}|{user}".encode()).hexdigest()
+
+# ─── SSE framing ──────────────────────────────────────────────────────────────
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+def sse(event: dict) -> bytes:
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+def sse_token_prefix(agent_key: str) -> bytes:
+    """Pre-serialised head of a token event; only the token itself varies per frame."""
+    return b'data: {"agent":' + orjson.dumps(agent_key) + b',"status":"token","token":'
+
+def sse_token(prefix: bytes, token: str) -> bytes:
+    return prefix + orjson.dumps(token) + b"}\n\n"
+
+SSE_PING = b": ping\n\n"
+SSE_PING_SECS = 15.0
+
+async def keepalive_stream(events: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """Emits an SSE comment whenever the pipeline is silent for SSE_PING_SECS,
+    so proxies don't drop the connection during long agent calls."""
+    pending = asyncio.ensure_future(events.__anext__())
+    try:
+        while True:
+            done, _ = await asyncio.wait({pending}, timeout=SSE_PING_SECS)
+            if not done:
+                yield SSE_PING
+                continue
+            try:
+                event = pending.result()
+            except StopAsyncIteration:
+                return
+            yield event
+            pending = asyncio.ensure_future(events.__anext__())
+    finally:
+        pending.cancel()
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await pending
+        await events.aclose()
+
+# GZipMiddleware buffers inside the compressor, which would stall live tokens,
+# so the stream is gzipped here with a sync flush after every event instead.
+# Opt-in: compressing SSE is not advisable by default, and intermediate proxies
+# must pass the flushed chunks through unbuffered for tokens to stay live.
+SSE_GZIP = os.getenv("SSE_GZIP", "0") == "1"
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """True if the Accept-Encoding header allows gzip with a non-zero q-value."""
+    allowed = {}
+    for part in accept_encoding.split(","):
+        coding, *params = part.strip().split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        allowed[coding.strip().lower()] = q
+    return allowed.get("gzip", allowed.get("*", 0.0)) > 0
+
+async def gzip_stream(events: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    async for event in events:
+        yield compressor.compress(event) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
 # ─── Streaming LLM call ───────────────────────────────────────────────────────
 
 async def llm_stream(
@@ -75,30 +273,57 @@ async def llm_stream(
     agent_key: str,
     system: str,
     user: str,
-) -> AsyncGenerator[str, None]:
-    """Streams tokens as SSE events and finally yields a 'done' event."""
-    full_text = []
-
-    def sse(event: dict) -> str:
-        return f"data: {json.dumps(event)}\n\n"
+    capture: list[str] | None = None,
+) -> AsyncGenerator[bytes, None]:
+    """Streams tokens as SSE events and finally yields a 'done' event.
+
+    If `capture` is given, raw tokens are appended to it as they arrive so
+    callers can rebuild the output without parsing the SSE frames.
+    """
+    full_text = [] if capture is None else capture
+    token_prefix = sse_token_prefix(agent_key)
+
+    use_cache = TEMPERATURE == 0 and CACHE_SIZE > 0
+    key = cache_key(system, user) if use_cache else ""
+    cached = lru_get(_cache, key) if use_cache else None
+    if cached is not None:
+        full_text.append(cached)
+        # Replay as token events so the UI streams exactly as on a live call
+        for i in range(0, len(cached), CACHE_REPLAY_CHARS):
+            yield sse_token(token_prefix, cached[i:i + CACHE_REPLAY_CHARS])
+        yield sse({"agent": agent_key, "status": "done", "output": cached})
+        return
 
     try:
-        stream = await client.chat.completions.create(
-            model=MODEL,
-            temperature=0.3,
-            stream=True,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user",   "content": user},
-            ],
-        )
-        async for chunk in stream:
-            token = chunk.choices[0].delta.content
-            if token:
-                full_text.append(token)
-                yield sse({"agent": agent_key, "status": "token", "token": token})
-
-        yield sse({"agent": agent_key, "status": "done", "output": "".join(full_text)})
+        async with get_llm_sem():
+            stream = await client.chat.completions.create(
+                model=MODEL,
+                temperature=TEMPERATURE,
+                stream=True,
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user",   "content": user},
+                ],
+            )
+            batch = []
+            last_flush = time.monotonic()
+            async for chunk in stream:
+                token = chunk.choices[0].delta.content
+                if token:
+                    full_text.append(token)
+                    batch.append(token)
+                    now = time.monotonic()
+                    if len(batch) >= TOKEN_BATCH_SIZE or now - last_flush > TOKEN_FLUSH_SECS:
+                        yield sse_token(token_prefix, "".join(batch))
+                        batch.clear()
+                        last_flush = now
+            if batch:
+                yield sse_token(token_prefix, "".join(batch))
+
+        output = "".join(full_text)
+        if use_cache:
+            lru_put(_cache, key, output, CACHE_SIZE)
+        yield sse({"agent": agent_key, "status": "done", "output": output})
 
     except Exception as e:
         yield sse({"agent": agent_key, "status": "error", "error": str(e)})
@@ -130,7 +355,7 @@ RULES:
 
 SYS_EVALUATOR = """
 You are a career strategist and resume fitness evaluator. Your job: cross-reference
-the CANDIDATE'S resume against the HR manager's company and role needs.
+the CANDIDATE'S resume against the HR manager's profile, company and role needs.
 
 IMPORTANT DIRECTION: The CANDIDATE is reaching out TO the HR manager, not the other way around.
 Evaluate the candidate's fit from the candidate's perspective.
@@ -162,108 +387,141 @@ RULES:
 
 AGENT_KEYS = ["profile_summary", "deep_research", "fitness_eval", "strategy"]
 
-def sse(event: dict) -> str:
-    return f"data: {json.dumps(event)}\n\n"
+# Status frames never vary, so they are encoded once here rather than per run.
+SSE_RUNNING = {k: sse({"agent": k, "status": "running"}) for k in AGENT_KEYS}
+
+NO_RESUME_EVAL = "## Fit Score: N/A\nNo resume was provided, so fitness could not be evaluated."
+
+async def merge_streams(*streams: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """Runs several agent streams at once, yielding frames as soon as any produces one."""
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(stream: AsyncGenerator[bytes, None]) -> None:
+        try:
+            async for chunk in stream:
+                await queue.put(chunk)
+        finally:
+            queue.put_nowait(None)
+
+    tasks = [asyncio.create_task(pump(s)) for s in streams]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            chunk = await queue.get()
+            if chunk is None:
+                remaining -= 1
+            else:
+                yield chunk
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 async def run_pipeline(
     linkedin_pdf: str,
     resume: str,
     resume_pdf: str = "",
-) -> AsyncGenerator[str, None]:
-
-    # Extract PDFs
-    try:
-        linkedin_text = extract_pdf_text(linkedin_pdf)
-    except Exception as e:
-        for k in AGENT_KEYS:
-            yield sse({"agent": k, "status": "error", "error": f"LinkedIn PDF: {e}"})
-        yield "data: [DONE]\n\n"
-        return
+) -> AsyncGenerator[bytes, None]:
 
+    # Extract PDFs off the event loop, both at once, so other streams keep flowing
+    sources = [("LinkedIn PDF", linkedin_pdf)]
     if resume_pdf:
-        try:
-            resume = extract_pdf_text(resume_pdf)
-        except Exception as e:
+        sources.append(("Resume PDF", resume_pdf))
+    results = await asyncio.gather(
+        *(asyncio.to_thread(extract_pdf_text, pdf) for _, pdf in sources),
+        return_exceptions=True,
+    )
+    for (label, _), result in zip(sources, results):
+        if isinstance(result, Exception):
             for k in AGENT_KEYS:
-                yield sse({"agent": k, "status": "error", "error": f"Resume PDF: {e}"})
-            yield "data: [DONE]\n\n"
+                yield sse({"agent": k, "status": "error", "error": f"{label}: {result}"})
+            yield SSE_DONE
             return
+    linkedin_text = results[0]
+    if resume_pdf:
+        resume = results[1]
 
     try:
         client = get_client()
     except Exception as e:
         for k in AGENT_KEYS:
             yield sse({"agent": k, "status": "error", "error": str(e)})
-        yield "data: [DONE]\n\n"
+        yield SSE_DONE
         return
 
     resume_block = f"CANDIDATE RESUME:\n{resume}" if resume.strip() \
-        else "No resume provided — evaluate generally."
+        else "No resume provided — keep the candidate's background general."
 
     # ── Agent 1: Profile Summarizer ───────────────────────────────────────────
-    yield sse({"agent": "profile_summary", "status": "running"})
+    yield SSE_RUNNING["profile_summary"]
     profile_summary = []
     async for chunk in llm_stream(client, "profile_summary", SYS_SUMMARIZER, f"""
-Analyse this LinkedIn profile PDF text and extract a structured summary.
+--- INSTRUCTIONS ---
+Analyse the LinkedIn profile PDF text below and extract a structured summary.
+Cover: name & title, career history (key milestones only), core skills,
+education, personality signals, what they value in candidates.
 
+--- INPUTS ---
 LINKEDIN PROFILE TEXT:
 {linkedin_text}
-
-Cover: name & title, career history (key milestones only), core skills,
-education, personality signals, what they value in candidates.
-"""):
-        if '"status": "token"' in chunk:
-            token = json.loads(chunk[6:])["token"]
-            profile_summary.append(token)
+""", capture=profile_summary):
         yield chunk
     profile_summary_text = "".join(profile_summary)
 
     # ── Agent 2: Deep Research ────────────────────────────────────────────────
-    yield sse({"agent": "deep_research", "status": "running"})
+    # Agents 2 and 3 both depend only on Agent 1, so they stream concurrently.
+    yield SSE_RUNNING["deep_research"]
     deep_research = []
-    async for chunk in llm_stream(client, "deep_research", SYS_RESEARCHER, f"""
-Research this HR manager's company based on their profile.
-
-HR MANAGER PROFILE:
-{profile_summary_text}
-
+    streams = [llm_stream(client, "deep_research", SYS_RESEARCHER, f"""
+--- INSTRUCTIONS ---
+Research the HR manager's company based on their profile below.
 Cover: company overview, recent news, culture signals, current hiring trends,
 strategic priorities, one unique angle a candidate could use in outreach.
 If live data unavailable, reason from context and industry knowledge.
-"""):
-        if '"status": "token"' in chunk:
-            token = json.loads(chunk[6:])["token"]
-            deep_research.append(token)
-        yield chunk
-    deep_research_text = "".join(deep_research)
+
+--- INPUTS ---
+HR MANAGER PROFILE:
+{profile_summary_text}
+""", capture=deep_research)]
 
     # ── Agent 3: Fitness Evaluation ───────────────────────────────────────────
-    yield sse({"agent": "fitness_eval", "status": "running"})
+    # Without a resume there is nothing to evaluate, so skip the LLM call
     fitness_eval = []
-    async for chunk in llm_stream(client, "fitness_eval", SYS_EVALUATOR, f"""
+    if not resume.strip():
+        fitness_eval.append(NO_RESUME_EVAL)
+        yield sse({"agent": "fitness_eval", "status": "done", "output": NO_RESUME_EVAL})
+    else:
+        yield SSE_RUNNING["fitness_eval"]
+        streams.append(llm_stream(client, "fitness_eval", SYS_EVALUATOR, f"""
+--- INSTRUCTIONS ---
+Using the candidate resume and HR manager profile below,
+evaluate: skills alignment, experience relevance, culture fit, gaps,
+unique value proposition, fit score 1-10 with justification.
+
+--- INPUTS ---
 {resume_block}
 
 HR MANAGER PROFILE:
 {profile_summary_text}
+""", capture=fitness_eval))
 
-COMPANY RESEARCH:
-{deep_research_text}
-
-Evaluate: skills alignment, experience relevance, culture fit, gaps,
-unique value proposition, fit score 1-10 with justification.
-"""):
-        if '"status": "token"' in chunk:
-            token = json.loads(chunk[6:])["token"]
-            fitness_eval.append(token)
+    async for chunk in merge_streams(*streams):
         yield chunk
+    deep_research_text = "".join(deep_research)
     fitness_eval_text = "".join(fitness_eval)
 
     # ── Agent 4: Strategic Planner ────────────────────────────────────────────
-    yield sse({"agent": "strategy", "status": "running"})
+    yield SSE_RUNNING["strategy"]
     async for chunk in llm_stream(client, "strategy", SYS_STRATEGIST, f"""
+--- INSTRUCTIONS ---
 You are helping THE CANDIDATE write a message TO the HR manager.
 THE CANDIDATE is the sender. THE HR MANAGER is the recipient.
+Using the inputs below, produce:
+1. ## APPROACH STRATEGY — 4 bullets on how the candidate should approach outreach
+2. ## OUTREACH MESSAGE — a complete message written in first person AS the candidate,
+   addressed to the HR manager by their first name. Under 150 words. No placeholder text.
 
+--- INPUTS ---
 --- CANDIDATE'S BACKGROUND (the SENDER) ---
 {resume_block}
 
@@ -275,15 +533,10 @@ THE CANDIDATE is the sender. THE HR MANAGER is the recipient.
 
 --- FITNESS EVALUATION ---
 {fitness_eval_text}
-
-Now produce:
-1. ## APPROACH STRATEGY — 4 bullets on how the candidate should approach outreach
-2. ## OUTREACH MESSAGE — a complete message written in first person AS the candidate,
-   addressed to the HR manager by their first name. Under 150 words. No placeholder text.
 """):
         yield chunk
 
-    yield "data: [DONE]\n\n"
+    yield SSE_DONE
 
 # ─── Routes ───────────────────────────────────────────────────────────────────
 
@@ -292,11 +545,16 @@ def health():
     return {"status": "ok", "model": MODEL}
 
 @app.post("/api/run")
-async def run_outreach(req: RunRequest):
+async def run_outreach(req: RunRequest, request: Request):
     if not req.linkedin_pdf:
         raise HTTPException(400, "linkedin_pdf is required.")
+    stream = keepalive_stream(run_pipeline(req.linkedin_pdf, req.resume, req.resume_pdf))
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Vary": "Accept-Encoding"}
+    if SSE_GZIP and accepts_gzip(request.headers.get("accept-encoding", "")):
+        stream = gzip_stream(stream)
+        headers["Content-Encoding"] = "gzip"
     return StreamingResponse(
-        run_pipeline(req.linkedin_pdf, req.resume, req.resume_pdf),
+        stream,
         media_type="text/event-stream",
-        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
-    )
\ No newline at end of file
+        headers=headers,
+    )